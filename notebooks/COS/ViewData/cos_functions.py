@@ -10,10 +10,51 @@ DESCRIPTION:
     
     The reason this file is defined separate of the Notebook is to prevent the Notebook from including large and confusing code chunks. In the future, these functions may be incorporated into a Python package, such as `COSTools`.
 """
+import math
+
 import numpy as np
 from astropy.table import Table
 import matplotlib.pyplot as plt
 
+try:
+    # Numba is optional: when it is installed, the binning helpers below
+    # run as compiled (SIMD) loops with no temporaries; without it they
+    # fall back to the pure-NumPy implementations.
+    from numba import njit
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+
+    @njit(cache=True, fastmath=True)
+    def _ds_sum(arr, factor):
+        """Compiled kernel: sum each consecutive *factor*-pixel bin."""
+        n = arr.size // factor
+        out = np.empty(n, dtype=arr.dtype)
+        for i in range(n):
+            acc = arr[i * factor]
+            for j in range(1, factor):
+                acc = acc + arr[i * factor + j]
+            out[i] = acc
+        return out
+
+    @njit(cache=True, fastmath=True)
+    def _ds_weighted_avg(arr, weights, factor):
+        """Compiled kernel: weighted mean of each *factor*-pixel bin."""
+        n = arr.size // factor
+        out = np.empty(n, dtype=np.float64)
+        for i in range(n):
+            num = 0.0
+            den = 0.0
+            base = i * factor
+            for j in range(factor):
+                num += arr[base + j] * weights[base + j]
+                den += weights[base + j]
+            out[i] = num / den
+        return out
+
 
 def downsample_sum(myarr, factor):
     """Downsamples a 1D array by summing over *factor* pixels; Crops right side if the shape is not a multiple of factor.
@@ -24,9 +65,14 @@ def downsample_sum(myarr, factor):
     """
     xs = myarr.shape[0]
     crop_arr = myarr[: xs - (xs % int(factor))]
-    dsarr = np.sum(
-        np.concatenate([[crop_arr[i::factor] for i in range(factor)]]), axis=0
-    )
+    if HAS_NUMBA:
+        # Coerce to a native-endian dtype: columns read straight from
+        # FITS tables are big-endian, which numba's typing rejects
+        return _ds_sum(np.ascontiguousarray(crop_arr, dtype=np.float64),
+                       int(factor))
+    # Viewing the cropped array as (n_bins, factor) is just a stride
+    # change (no copy); the sum then runs as one vectorized pass per bin
+    dsarr = crop_arr.reshape(-1, int(factor)).sum(axis=1)
     return dsarr
 
 
@@ -55,23 +101,28 @@ def downsample_1d(myarr, factor, weightsarr=[-1], weighted=True, in_quad=False):
     crop_arr = myarr[: xs - (xs % int(factor))]
     crop_weights = weightsarr[: xs - (xs % int(factor))]
 
+    # Each row of the (n_bins, factor) view below is one bin of
+    # consecutive pixels; reshaping is a stride change rather than a
+    # copy, so the reduction runs in a single vectorized pass
     if weighted:
         if np.mean(weightsarr) == -1:
             print("CAUTION!!!! You didn't specify what to weight by!")
             dsarr = -1
+        elif HAS_NUMBA:
+            dsarr = _ds_weighted_avg(
+                np.ascontiguousarray(crop_arr, dtype=np.float64),
+                np.ascontiguousarray(crop_weights, dtype=np.float64),
+                int(factor),
+            )
         else:
             dsarr = np.average(
-                np.concatenate([[crop_arr[i::factor] for i in range(factor)]]),
-                weights=np.concatenate(
-                    [[crop_weights[i::factor] for i in range(factor)]]
-                ),
-                axis=0,
+                crop_arr.reshape(-1, int(factor)),
+                weights=np.asarray(crop_weights).reshape(-1, int(factor)),
+                axis=1,
             )
 
     else:
-        dsarr = np.mean(
-            np.concatenate([[crop_arr[i::factor] for i in range(factor)]]), axis=0
-        )
+        dsarr = np.mean(crop_arr.reshape(-1, int(factor)), axis=1)
     if in_quad:
         dsarr = np.sqrt(dsarr)
     return dsarr
@@ -99,48 +150,83 @@ def bin_by_resel(data_table, binsize=6, weighted=True, verbose=True):
     assert (
         binsize > 1 and type(binsize) is int
     ), "Binsize must be an integer greater than 1."
-    exptimes_ = []
+    # Hoisted out of the segment loop: one scalar sqrt for the whole
+    # call, applied below as an in-place multiply on each error array
+    inv_sqrt_binsize = 1.0 / math.sqrt(binsize)
+    # Preallocate the output columns up front: scalar exposure times in
+    # a float array, the per-segment arrays in object arrays that get
+    # stacked into contiguous 2-D columns once the loop is done
+    n_rows = len(data_table)
+    exptimes_ = np.empty(n_rows)
     wvlns_, fluxs_, fluxErrs_, fluxErr_lowers_, gross_s_, gcount_s_ = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
+        np.empty(n_rows, dtype=object) for _ in range(6)
     )
 
-    print(f"function `bin_by_resel` is binning by {binsize}")
+    if verbose:
+        print(f"function `bin_by_resel` is binning by {binsize}")
+    # Pull each column out of the Table once as a NumPy array; indexing
+    # plain arrays inside the loop avoids building an astropy Row (and
+    # doing its per-column lookups) for every segment
+    cols = {
+        name: np.asarray(data_table[name])
+        for name in (
+            "EXPTIME",
+            "WAVELENGTH",
+            "FLUX",
+            "ERROR",
+            "ERROR_LOWER",
+            "GROSS",
+            "GCOUNTS",
+        )
+    }
     for i in range(len(data_table)):
-        exptimes_.append(data_table[i]["EXPTIME"])
-        wvln_, flux_, fluxErr_, fluxErr_lower_, gross_, gcount_ = data_table[i][
-            "WAVELENGTH", "FLUX", "ERROR", "ERROR_LOWER", "GROSS", "GCOUNTS"
-        ]
+        exptimes_[i] = cols["EXPTIME"][i]
+        wvln_, flux_, fluxErr_, fluxErr_lower_, gross_, gcount_ = (
+            cols["WAVELENGTH"][i],
+            cols["FLUX"][i],
+            cols["ERROR"][i],
+            cols["ERROR_LOWER"][i],
+            cols["GROSS"][i],
+            cols["GCOUNTS"][i],
+        )
         if weighted:
-            np.seterr(
-                invalid="ignore"
-            )  # We want to silence warnings from  dividing 0/0
+            # Exposure time can be calculated by gross counts divided by gross counts/second
+            # Where gross is 0 the ratio is undefined, so those weights are filled
+            # with a value << exptime - this way, weight is ~0 unless all values in
+            # a chunk are empty. Writing into a prefilled output array (instead of
+            # dividing first and patching the NaNs afterwards) never produces the
+            # invalid values, so there is no np.seterr toggling around the division.
             weightsarr_ = np.nan_to_num(
-                gcount_ / gross_, nan=1e-30
-            )  # Exposure time can be calculated by gross counts divided by gross counts/second
-            # Dividing this way results in NaNs which are messy. replace nans with a value << exptime
-            # This way, weight is ~0 unless all values in a chunk are NaN
-            np.seterr(invalid="warn")
-            wvln_ = downsample_1d(myarr=wvln_, weightsarr=weightsarr_, factor=binsize)
-            flux_ = downsample_1d(myarr=flux_, weightsarr=weightsarr_, factor=binsize)
-            fluxErr_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
+                np.divide(
+                    gcount_,
+                    gross_,
+                    out=np.full(gcount_.shape, 1e-30),
+                    where=gross_ != 0,
                 ),
-                np.sqrt(binsize),
-            ) 
+                nan=1e-30,
+            )
+            # Wavelength and flux are averaged with the same weights, so binning
+            # them stacked lets a single np.average pass produce both columns
+            crop = wvln_.shape[0] - (wvln_.shape[0] % binsize)
+            weights2d = weightsarr_[:crop].reshape(-1, binsize)
+            stacked = np.stack(
+                [wvln_[:crop].reshape(-1, binsize), flux_[:crop].reshape(-1, binsize)]
+            )
+            wvln_, flux_ = np.average(
+                stacked,
+                weights=np.broadcast_to(weights2d, stacked.shape),
+                axis=2,
+            )
+            fluxErr_ = downsample_1d(
+                myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
+            )
+            fluxErr_ *= inv_sqrt_binsize
             # Errors are divided by the sqrt of the number of (identical) observations they represent
             # this is idealized and simplified. It is good for an estimation.
-            fluxErr_lower_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+            fluxErr_lower_ = downsample_1d(
+                myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
             )
+            fluxErr_lower_ *= inv_sqrt_binsize
             gross_ = downsample_sum(myarr=gross_, factor=binsize)
             gcount_ = downsample_sum(myarr=gcount_, factor=binsize)
 
@@ -149,30 +235,43 @@ def bin_by_resel(data_table, binsize=6, weighted=True, verbose=True):
 
             wvln_ = downsample_1d(myarr=wvln_, weighted=False, factor=binsize)
             flux_ = downsample_1d(myarr=flux_, weighted=False, factor=binsize)
-            fluxErr_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+            fluxErr_ = downsample_1d(
+                myarr=fluxErr_, weighted=False, factor=binsize, in_quad=False
             )
-            fluxErr_lower_ = np.divide(
-                downsample_1d(
-                    myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
-                ),
-                np.sqrt(binsize),
+            fluxErr_ *= inv_sqrt_binsize
+            fluxErr_lower_ = downsample_1d(
+                myarr=fluxErr_lower_, weighted=False, factor=binsize, in_quad=False
             )
+            fluxErr_lower_ *= inv_sqrt_binsize
             gross_ = downsample_sum(myarr=gross_, factor=binsize)
             gcount_ = downsample_sum(myarr=gcount_, factor=binsize)
 
-        wvlns_.append(wvln_)
-        fluxs_.append(flux_)
-        fluxErrs_.append(fluxErr_)
-        fluxErr_lowers_.append(fluxErr_lower_)
-        gross_s_.append(gross_)
-        gcount_s_.append(gcount_)
+        wvlns_[i] = wvln_
+        fluxs_[i] = flux_
+        fluxErrs_[i] = fluxErr_
+        fluxErr_lowers_[i] = fluxErr_lower_
+        gross_s_[i] = gross_
+        gcount_s_[i] = gcount_
+
+    def _stack(col):
+        # Segments almost always bin to the same length, in which case
+        # stacking yields one contiguous 2-D column; fall back to the
+        # ragged object column when they differ
+        try:
+            return np.stack(list(col))
+        except ValueError:
+            return col
 
     return Table(
-        [exptimes_, wvlns_, fluxs_, fluxErrs_, fluxErr_lowers_, gross_s_, gcount_s_],
+        [
+            exptimes_,
+            _stack(wvlns_),
+            _stack(fluxs_),
+            _stack(fluxErrs_),
+            _stack(fluxErr_lowers_),
+            _stack(gross_s_),
+            _stack(gcount_s_),
+        ],
         names=[
             "EXPTIME",
             "WAVELENGTH",
@@ -223,6 +322,9 @@ def estimate_snr(
     # STEP TWO - ESTIMATE SNR
     for i in range(len(data_table)):
         wvln_, gross_, gcount_ = data_table[i]["WAVELENGTH", "GROSS", "GCOUNTS"]
+        # One compiled ufunc pass each, reused by the range test and the
+        # prints below (the builtin min/max would iterate pixel by pixel)
+        wvln_min, wvln_max = wvln_.min(), wvln_.max()
 
         # No range specified - estimates over the whole range
         snr_array.append([wvln_, np.sqrt(gcount_), i])
@@ -231,7 +333,7 @@ def estimate_snr(
                 print("No range specified.")
 
         else:
-            if (min(snr_range) > min(wvln_)) & (max(snr_range) < max(wvln_)):
+            if (min(snr_range) > wvln_min) & (max(snr_range) < wvln_max):
                 segsFound += 1
                 wvln_range_mask = (wvln_ > snr_range[0]) & (wvln_ < snr_range[1])
 
@@ -241,28 +343,39 @@ def estimate_snr(
                     gross_[wvln_range_mask],
                 )
 
-                snr_array.append([wvln_range, np.sqrt(gcount_range), i])
+                # The square root is needed by the array below and by both
+                # averaging branches, so take it once
+                sqrt_gcount_range = np.sqrt(gcount_range)
+                snr_array.append([wvln_range, sqrt_gcount_range, i])
 
                 if weighted is False:
-                    weight_avg_snr = np.mean(np.sqrt(gcount_range))
+                    weight_avg_snr = np.mean(sqrt_gcount_range)
                     if verbose:
                         print(
                             f"In range on {i}-th segment with limits:",
-                            min(wvln_),
-                            max(wvln_),
+                            wvln_min,
+                            wvln_max,
                             f"\nUnweighted mean SNR over the range {snr_range} is: {weight_avg_snr}",
                         )
 
                 if weighted:
                     weight_avg_snr = np.average(
-                        np.sqrt(gcount_range),
-                        weights=np.nan_to_num(gcount_range / gross_range, nan=1e-30),
+                        sqrt_gcount_range,
+                        weights=np.nan_to_num(
+                            np.divide(
+                                gcount_range,
+                                gross_range,
+                                out=np.full(gcount_range.shape, 1e-30),
+                                where=gross_range != 0,
+                            ),
+                            nan=1e-30,
+                        ),
                     )
                     if verbose:
                         print(
                             f"In range on {i}-th segment with limits:",
-                            min(wvln_),
-                            max(wvln_),
+                            wvln_min,
+                            wvln_max,
                             f"\nEXPTIME weighted average SNR over the range {snr_range} is: {weight_avg_snr}",
                         )
             else:
@@ -270,8 +383,8 @@ def estimate_snr(
                 if verbose:
                     print(
                         f"Out of range on {i}-th segment with limits:",
-                        min(wvln_),
-                        max(wvln_),
+                        wvln_min,
+                        wvln_max,
                     )
     if (  # Check whether the code has found any specified wavelength ranges
         all([elem == -1 for elem in (snr_array[0][2], snr_array[1][2])])
@@ -5,6 +5,7 @@
 import os
 import glob
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 
@@ -58,6 +59,12 @@ def copy_files_check(src_dir, dst_dir, files='*', rename=False, src_str='', dst_
     # Get full input directories
     src_dir_full = os.path.abspath(src_dir)
     dst_dir_full = os.path.abspath(dst_dir)
+
+    # Precompute the directory prefixes once: plain concatenation in the
+    # loop below avoids an os.path.join call (and its separator logic)
+    # for every file
+    src_prefix = src_dir_full + os.sep
+    dst_prefix = dst_dir_full + os.sep
     
     # Move to source directory to get files
     os.chdir(src_dir_full)
@@ -94,40 +101,50 @@ def copy_files_check(src_dir, dst_dir, files='*', rename=False, src_str='', dst_
         os.makedirs(dst_dir_full, 0o774)
         print('Created destination directory:', dst_dir)  
     
-    # If printing the copy command, set the starting cmd variable
-    if print_cmd == True: cmd = ''
+    # List the source and destination directories once up front: the set
+    # membership tests below replace a stat syscall per candidate file, which
+    # adds up quickly on large file lists or network filesystems
+    src_files = {entry.name for entry in os.scandir(src_dir_full) if entry.is_file()}
+    existing = {entry.name for entry in os.scandir(dst_dir_full)}
+
+    # If printing the copy command, collect the per-file commands in a list
+    # and join them once at the end - growing a string with += reallocates
+    # the whole buffer each time and goes quadratic on long file lists
+    if print_cmd == True: cmd_parts = []
         
-    # Loop over each file, create a source and destination, check if it exists, and copy/move if not 
+    # Loop over each file, create a source and destination, check if it exists, and
+    # collect it for copying/moving if not. The transfers themselves are dispatched
+    # to a thread pool after the loop - each worker releases the GIL during its
+    # blocking file I/O, so several files are in flight at once.
     n=0
+    tasks = []
     for file in files:
-        if os.path.isfile(file):
+        if file in src_files:
             # Define source and destination paths for each file
-            src_full = os.path.join(src_dir_full, file)              # Full source filepath of file to be copied/moved
+            src_full = src_prefix + file                             # Full source filepath of file to be copied/moved
             src = os.path.join(src_dir, file)                        # Relative path for printing
 
             # If a file is to be renamed with a replacement extension
             if rename == False:
-                dst_full = os.path.join(dst_dir_full, file)   # Full estination filepath of file to be copied/moved and renamed
+                dst_full = dst_prefix + file                  # Full destination filepath of file to be copied/moved and renamed
                 dst = os.path.join(dst_dir, file) 
             else: 
                 # Replace the specified component with the new component
-                dst_full = os.path.join(ddst_dir_full, file.replace(src_str, dst_str)) 
+                dst_full = dst_prefix + file.replace(src_str, dst_str) 
                 dst = os.path.join(dst_dir, file.replace(src_str, dst_str))
 
             # Check if the file is already in the destination directory, if not it is copied/moved
-            if not os.path.exists(dst_full):
+            if os.path.basename(dst_full) not in existing:
                 # Either copy/move the files or add to the cmd variable
                 if print_cmd == False:
                     if move == False:
                         print('Copying{} {} to {}'.format(rnm_str, src, dst))
-                        shutil.copy(src_full, dst_full)
                     else:
                         print('~Moving~{} {} to {}'.format(rnm_str, src, dst))
-                        shutil.move(src_full, dst_full)
+                    tasks.append((src_full, dst_full))
                 # Or set command to copy/move the file to print for command line
                 else:
-                    if n > 0: cmd += ' && '
-                    cmd += '{} {} {}'.format(md, src_full, dst_full)
+                    cmd_parts.append('{} {} {}'.format(md, src_full, dst_full))
                 n += 1
             else:
                 if move == False:
@@ -136,11 +153,29 @@ def copy_files_check(src_dir, dst_dir, files='*', rename=False, src_str='', dst_
                     print('File exists: {}, not ~moving~ from {}'.format(dst, src_dir))
         else: print('WARNING: {} is not a file, skipping...'.format(file))
 
+    # Run the collected transfers through a thread pool. Copies use
+    # shutil.copyfile, which skips shutil.copy's extra stat/chmod and takes the
+    # kernel's zero-copy (sendfile) path on Linux; moves try os.replace first -
+    # a single rename syscall when source and destination share a filesystem -
+    # and fall back to shutil.move (copy + unlink) across filesystems.
+    if tasks:
+        if move:
+            def op(src, dst):
+                try:
+                    os.replace(src, dst)
+                except OSError:
+                    shutil.move(src, dst)
+        else:
+            op = shutil.copyfile
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda task: op(*task), tasks))
+
     # Move back into working directory
     os.chdir(cwd)
 
     # Print the command to copy the files or a summary of the copied files
     if print_cmd == True:
+        cmd = ' && '.join(cmd_parts)
         # Check if all the specified files with the string extension provided need to be copied/moved
         if isinstance(files_ext, str) and ('*' in files_ext) and (len(files) == n) and (rename == False):
             all_files = os.path.join(src_dir_full, files_ext)
@@ -180,21 +215,24 @@ def rename(direc, files='*', src_str='', dst_str=''):
 
     """
  
-    # Move to input directroy
+    # Get the full input directory; absolute paths are passed straight to
+    # os.rename below, so there is no need to chdir into the directory (a
+    # process-global side effect) or to re-resolve the cwd on every rename
     dir_full = os.path.abspath(direc)
-    os.chdir(dir_full)
 
     # Check for files to rename
     # If a string is provided for the files, make a list with glob, else assume a list if provided 
     if isinstance(files, str):
         files_ext = files
-        files = glob.glob(files)
+        files = glob.glob(os.path.join(dir_full, files))
     else:
         files_ext = None
+        files = [os.path.join(dir_full, f) for f in files]
 
     # List all specified files and rename 
     for f in files:
-        os.rename(f, f.replace(src_str, dst_str))
+        head, tail = os.path.split(f)
+        os.rename(f, os.path.join(head, tail.replace(src_str, dst_str)))
     print('--------------------------------------------')
-    print('Renamed {} files in {} from {} to {}'.format(len(glob.glob('*{}*'.format(dst_str))), direc, src_str, dst_str))
+    print('Renamed {} files in {} from {} to {}'.format(sum(1 for entry in os.scandir(dir_full) if dst_str in entry.name), direc, src_str, dst_str))
     print('--------------------------------------------')
\ No newline at end of file
@@ -19,9 +19,92 @@ Author
 Fred Dauphin, February 2024
 """
 
+import functools
+import hashlib
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from astropy.io import fits
 from astroquery.mast import Mast
 
+# Shared session for all MAST downloads. Reusing one session keeps the
+# TCP/TLS connections to mast.stsci.edu alive between requests, so bulk
+# cutout downloads skip a new handshake per file. Created lazily so
+# importing the module stays side-effect free.
+_SESSION = None
+
+
+def _get_session():
+    """Return the module-level pooled `requests.Session`, creating it once."""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        # Retry transient failures (throttling, gateway errors) inside
+        # the adapter with exponential backoff: the pooled connection is
+        # reused after the sleep and one flaky response no longer kills
+        # a download out of a whole batch
+        retries = Retry(total=5, backoff_factor=0.3,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=['GET', 'POST'])
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=retries)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+# Prepared GET template for the single-file endpoint, built once. Each
+# download copies it and re-prepares only the query string, skipping the
+# per-call header construction and full URL encoding of session.get.
+_REQ_TEMPLATE = None
+
+
+def _prepare_file_request(dataURI):
+    """Return a PreparedRequest for downloading a single dataURI."""
+    global _REQ_TEMPLATE
+    if _REQ_TEMPLATE is None:
+        _REQ_TEMPLATE = _get_session().prepare_request(
+            requests.Request(
+                'GET', 'https://mast.stsci.edu/api/v0.1/Download/file'))
+    req = _REQ_TEMPLATE.copy()
+    req.prepare_url('https://mast.stsci.edu/api/v0.1/Download/file',
+                    {'uri': dataURI})
+    return req
+
+
+# Reuse pooled keep-alive connections for the API queries as well, so
+# repeated service_request calls share sockets instead of reconnecting.
+Mast._session.mount('https://', HTTPAdapter(pool_maxsize=8))
+
+# Cache of completed queries keyed on (detector, filters, columns), so
+# re-running an identical exploratory query skips the server round trip.
+_QUERY_CACHE = {}
+
+# On-disk cache of downloaded cutouts keyed by dataURI, so re-running a
+# notebook skips the HTTP fetch for files it already has. Entries are
+# hard-linked into place, sharing one inode with the working copy.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wfc3_psf')
+
+
+def _cache_path(dataURI):
+    """Return the stable cache path for a dataURI."""
+    digest = hashlib.blake2b(dataURI.encode(), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, digest)
+
+
+def _freeze(obj):
+    """Recursively convert lists and dicts into hashable tuples."""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
 
 # Helper functions from https://mast.stsci.edu/api/v0/pyex.html
 def set_filters(parameters):
@@ -71,15 +154,256 @@ def download_request(payload, filename, download_type="file"):
         The name of the downloaded file.
     """
     request_url = 'https://mast.stsci.edu/api/v0.1/Download/' + download_type
-    resp = requests.post(request_url, data=payload)
- 
+
+    # Stream the response to disk in 1 MiB chunks: a full bundle can be
+    # many GB, and resp.content would buffer all of it in memory first.
+    with _get_session().post(request_url, data=payload, stream=True) as resp:
+        resp.raise_for_status()
+        with open(filename, 'wb') as FLE:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                FLE.write(chunk)
+
+    return filename
+
+
+def download_request_file(dataURI, path_dir='.'):
+    """
+    Download a single file from the MAST server by its dataURI.
+
+    Parameters
+    ----------
+    dataURI : str or tuple
+        The dataURI to download. Tuples as produced by `make_dataURIs`,
+        i.e. ('uri', dataURI), are unpacked automatically.
+    path_dir : str, default='.'
+        The directory to save the file in.
+
+    Returns
+    -------
+    filename : str
+        The path of the downloaded file.
+    """
+    if type(dataURI) is tuple:
+        dataURI = dataURI[1]
+    # rsplit with a limit stops after the final separator instead of
+    # scanning and splitting the whole URI just to keep its last segment
+    filename = os.path.join(path_dir, dataURI.rsplit('/', 1)[-1])
+
+    # Serve cache hits without touching the network; hard-link so the
+    # cached copy and the working copy share one inode (no double disk
+    # usage), falling back to a copy across filesystems
+    cache_path = _cache_path(dataURI)
+    if os.path.exists(cache_path):
+        if not os.path.exists(filename):
+            try:
+                os.link(cache_path, filename)
+            except OSError:
+                shutil.copyfile(cache_path, filename)
+        return filename
+
+    resp = _get_session().send(_prepare_file_request(dataURI), stream=True)
+    resp.raise_for_status()
     with open(filename, 'wb') as FLE:
-        FLE.write(resp.content)
- 
+        for chunk in resp.iter_content(chunk_size=1024 * 1024):
+            FLE.write(chunk)
+
+    # Populate the cache; a failed link (e.g. cross-device) just means
+    # the next run downloads again
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    try:
+        os.link(filename, cache_path)
+    except OSError:
+        pass
+
     return filename
 
 
+def download_request_files(dataURIs, path_dir='.', workers=16):
+    """
+    Download files from the MAST server concurrently.
+
+    The downloads are network-bound, so they run on a thread pool: each
+    thread releases the GIL while waiting on its HTTP response, letting
+    many requests overlap on the shared pooled session.
+
+    Parameters
+    ----------
+    dataURIs : list
+        The dataURIs to download, as produced by `make_dataURIs`.
+    path_dir : str, default='.'
+        The directory to save the files in.
+    workers : int, default=16
+        The number of concurrent downloads. The threads spend their time
+        waiting on the network, so the default is deliberately larger
+        than a typical CPU count.
+
+    Returns
+    -------
+    filenames : list
+        The paths of the downloaded files.
+    """
+    os.makedirs(path_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        filenames = list(pool.map(
+            lambda dataURI: download_request_file(dataURI, path_dir),
+            dataURIs))
+
+    return filenames
+
+
+def download_cutouts(dataURIs, filename='mast_cutouts.tar.gz', path_dir='.',
+                     threshold=500):
+    """
+    Download cutouts, choosing the cheapest transfer for the batch size.
+
+    Small batches are fetched file-by-file through the concurrent
+    downloader; above `threshold` files, one bundle POST amortizes the
+    per-request server and round-trip overhead across the whole batch.
+
+    Parameters
+    ----------
+    dataURIs : list
+        The dataURIs to download, as produced by `make_dataURIs`.
+    filename : str, default='mast_cutouts.tar.gz'
+        The name of the bundle, used when the bundle endpoint is chosen.
+    path_dir : str, default='.'
+        The directory to save the files in.
+    threshold : int, default=500
+        The batch size above which the bundle endpoint is used.
+
+    Returns
+    -------
+    filenames : str or list
+        The path of the bundle, or the paths of the downloaded files.
+    """
+    if len(dataURIs) > threshold:
+        return download_request(dataURIs,
+                                filename=os.path.join(path_dir, filename),
+                                download_type='bundle.tar.gz')
+    return download_request_files(dataURIs, path_dir=path_dir)
+
+
+def download_request_bundles(dataURIs, filename_prefix, chunk_size=5000,
+                             workers=8):
+    """
+    Download cutouts as several bundles fetched concurrently.
+
+    A single bundle POST is serial: the server builds the whole tar.gz
+    before the client sees the last byte. Splitting the request into
+    chunks and posting them on a thread pool overlaps the server-side
+    tar construction of one chunk with the network transfer of another.
+
+    Parameters
+    ----------
+    dataURIs : list
+        The dataURIs to download, as produced by `make_dataURIs`.
+    filename_prefix : str
+        The prefix for the bundle names; chunk k is saved as
+        '{filename_prefix}.part{k}.tar.gz'.
+    chunk_size : int, default=5000
+        The number of dataURIs per bundle.
+    workers : int, default=8
+        The number of concurrent bundle downloads.
+
+    Returns
+    -------
+    filenames : list
+        The paths of the downloaded bundles.
+    """
+    chunks = [dataURIs[i:i + chunk_size]
+              for i in range(0, len(dataURIs), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        filenames = list(pool.map(
+            lambda ic: download_request(ic[1],
+                                        f'{filename_prefix}.part{ic[0]}.tar.gz',
+                                        download_type='bundle.tar.gz'),
+            enumerate(chunks)))
+
+    return filenames
+
+
+def fetch_cutouts(dataURIs, workers=16):
+    """
+    Fetch cutouts straight into memory as arrays, skipping the disk.
+
+    Each worker downloads a cutout once over the shared session and
+    parses the bytes in place with `fits.getdata(io.BytesIO(...))`, so
+    there is no second fetch by astropy and no intermediate file.
+
+    Parameters
+    ----------
+    dataURIs : list
+        The dataURIs to fetch, as produced by `make_dataURIs`.
+    workers : int, default=16
+        The number of concurrent downloads.
+
+    Returns
+    -------
+    cutouts : list of numpy.ndarray
+        The cutout data arrays, in the order of `dataURIs`.
+    """
+    def _fetch(dataURI):
+        if type(dataURI) is tuple:
+            dataURI = dataURI[1]
+        resp = _get_session().send(_prepare_file_request(dataURI))
+        resp.raise_for_status()
+        return fits.getdata(io.BytesIO(resp.content))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        cutouts = list(pool.map(_fetch, dataURIs))
+
+    return cutouts
+
+
 # Main functions
+@functools.lru_cache(maxsize=None)
+def _resolve_service_and_cols(detector, columns):
+    """
+    Resolve the MAST service name and column string for a detector.
+
+    Memoized on (detector, columns) so batch workflows sweeping one
+    parameter do not redo the service lookup, the WFPC2 column rename,
+    or the column join on every call.
+
+    Parameters
+    ----------
+    detector : str
+        The detector of the database to query, already validated and
+        upper-cased.
+    columns : tuple
+        The columns to return for the query, as a hashable tuple.
+
+    Returns
+    -------
+    service, cols : tuple of str
+        The service name and the comma-joined column string.
+    """
+    # Determine service for database
+    service_base = 'Mast.Catalogs.Filtered'
+    if detector == 'UVIS':
+        database = 'Wfc3Psf.Uvis'
+    elif detector == 'IR':
+        database = 'Wfc3Psf.Ir'
+    else:
+        database = 'Wfpc2Psf.Uvis'
+    service = f'{service_base}.{database}'
+
+    # If WFPC2, change filter to filter_1
+    if detector == 'WFPC2':
+        columns = tuple('filter_1' if col == 'filter' else col
+                        for col in columns)
+
+    # Determine columns to query
+    if '*' in columns:
+        cols = '*'
+    else:
+        cols = ','.join(columns)
+
+    return service, cols
+
+
 def mast_query_psf_database(detector, filts, columns=['*']):
     """
     Query the WFC3/WFPC2 PSF databases on the MAST Portal using the MAST API.
@@ -121,72 +445,61 @@ def mast_query_psf_database(detector, filts, columns=['*']):
     valid_detectors = ['UVIS', 'IR', 'WFPC2']
     detector = detector.upper()
     if detector not in valid_detectors:
-        raise ValueError(f'{detector} is not a valid detector. ' 
+        raise ValueError(f'{detector} is not a valid detector. '
                          f'Choose from {valid_detectors}.')
-    
-    # Determine service for database
-    service_base = 'Mast.Catalogs.Filtered'
-    if detector == 'UVIS':
-        database = 'Wfc3Psf.Uvis'
-    elif detector == 'IR':
-        database = 'Wfc3Psf.Ir'
-    else:
-        database = 'Wfpc2Psf.Uvis'
-    service = f'{service_base}.{database}'
-    
-    # If WFPC2, change filter to filter_1
+
+    # Return a copy of the cached result for repeated identical queries
+    cache_key = (detector, _freeze(filts), _freeze(columns))
+    cached = _QUERY_CACHE.get(cache_key)
+    if cached is not None:
+        return cached.copy()
+
+    # Resolve the service name and column string (memoized)
+    service, cols = _resolve_service_and_cols(detector, tuple(columns))
+
+    # If WFPC2, change filter to filter_1 in the query filters
     if detector == 'WFPC2':
-        if 'filter' in columns:
-            index = columns.index('filter')
-            columns[index] = 'filter_1'
         for param in filts:
             if 'filter' in param.values():
                 param['paramName'] = 'filter_1'
 
-    # Determine columns to query
-    if '*' in columns:
-        cols = '*'
-    else:
-        cols = ','.join(columns)
-    
     # Set parameters and query database
     params = {'columns': cols,
               'filters': filts}
     obs = Mast.service_request(service, params)
-    
+    _QUERY_CACHE[cache_key] = obs.copy()
+
     return obs
 
 
-def make_dataURIs(obs, detector, file_suffix, sizes={'unsat': 51, 'sat': 101}):
+def iter_dataURIs(obs, detector, file_suffix, sizes={'unsat': 51, 'sat': 101}):
     """
-    Make dataURIs for the WFC3 and WFPC2 PSF databases' sources.
-    
-    The dataURIs are URLs for downloading cutouts from the MAST Portal.
-    The cutouts are made using the package fitscut.
-    They can retrieve: 
-        - raw data with suffixes 'raw' for WFC3 and 'd0m' for WFPC2.
-        - calibrated data with suffixes 'flt' for WFC3 and 'c0m' for WFPC2.
-        - charge transfer efficiency (CTE) corrected data with the suffix 'flc' 
-          for UVIS.
-    
+    Lazily generate dataURIs for the WFC3 and WFPC2 PSF databases' sources.
+
+    Generator form of `make_dataURIs`: dataURIs are yielded one at a
+    time as they are built, so consumers such as the download helpers
+    can start fetching before generation finishes and never hold all
+    of the URI strings in memory at once. Arguments are validated
+    eagerly, before the first item is produced.
+
     Parameters
     ----------
     obs : astropy.table.Table
-        A table of the queried sources' metadata with specific filters and 
+        A table of the queried sources' metadata with specific filters and
         columns applied.
     detector : str
-        The detector of the queried sources. Allowed values are UVIS, IR, and 
+        The detector of the queried sources. Allowed values are UVIS, IR, and
         WFPC2.
     file_suffix : list
         The file suffixes to prepare for download.
     sizes : dict, default={'unsat':51, 'sat':101}
-        The sizes for unsaturated (qfit>0;n_sat_pixels==0) and saturated 
+        The sizes for unsaturated (qfit>0;n_sat_pixels==0) and saturated
         (qfit==0;n_sat_pixels>0) cutouts.
-    
+
     Returns
     -------
-    dataURIs : list
-        The dataURIs made from the queried sources as ('uri', dataURI).
+    dataURIs : iterator
+        Yields the dataURIs made from the queried sources as ('uri', dataURI).
     """
     # Check type
     if type(file_suffix) is not list:
@@ -218,46 +531,90 @@ def make_dataURIs(obs, detector, file_suffix, sizes={'unsat': 51, 'sat': 101}):
     dataURI_base = f'mast:{instrument}PSF/url/cgi-bin/fitscut.cgi'
 
     # Loop through obs to make dataURIs
-    dataURIs = []
     pixel_offset = 1 # centers sources
     mask_full_frame = (obs['subarray'] == 0).data # only support full frame
-    for row in obs[mask_full_frame]:
-        # Unpack values
-        iden = row['id']
-        root = row['rootname']
-        if detector == 'WFPC2':
-            filt = row['filter_1']
-        else:
-            filt = row['filter']
-        x = row['psf_x_center'] - pixel_offset
-        y = row['psf_y_center'] - pixel_offset
-        chip = row['chip']
-        qfit = row['qfit']
-        if qfit > 0:
-            size = sizes['unsat']
-        else:
-            size = sizes['sat']
-            
-        # If UVIS use chip to asign correct sci ext
-        if detector == 'UVIS':
-            if chip == '2':
-                sci_ext = 1
-            elif chip == '1':
-                sci_ext = 4
-                if y >= 2051:
-                    y -= 2051 - 3 # another offset to center UVIS1 sources
-        # Else chip is the correct sci ext
-        else:
-            sci_ext = chip
-            
-        # Make dataURIs for each suffix
-        for suffix in file_suffix:
-            file_read = f'red={root}_{suffix}[{sci_ext}]'
-            cutout = f'size={size}&x={x}&y={y}&format=fits'
-            file_save = f'{root}_{iden}_{filt}_{suffix}_cutout.fits'
-            dataURI = f'{dataURI_base}?{file_read}&{cutout}/{file_save}'
-            dataURIs.append(("uri", dataURI))
-    
+    full_frame = obs[mask_full_frame]
+
+    # Pull each column out of the table once: per-row astropy indexing
+    # re-resolves every column name for every row, which dominates the
+    # runtime on large queries. Iterating zipped column arrays keeps the
+    # loop body identical while touching each column buffer sequentially.
+    ids = full_frame['id'].data
+    roots = full_frame['rootname'].data
+    if detector == 'WFPC2':
+        filts = full_frame['filter_1'].data
+    else:
+        filts = full_frame['filter'].data
+    xs = full_frame['psf_x_center'].data - pixel_offset
+    ys = full_frame['psf_y_center'].data - pixel_offset
+    chips = full_frame['chip'].data
+    sizes_arr = np.where(full_frame['qfit'].data > 0,
+                         sizes['unsat'], sizes['sat'])
+
+    # If UVIS use chip to asign correct sci ext (chip 2 is ext 1, chip 1
+    # is ext 4), else chip is the correct sci ext. Both the extension
+    # lookup and the UVIS1 recentering offset are computed for all rows
+    # at once with np.where, replacing the per-row chip branches.
+    if detector == 'UVIS':
+        mask_uvis1 = chips == '1'
+        sci_exts = np.where(mask_uvis1, 4, 1)
+        # another offset to center UVIS1 sources
+        ys = np.where(mask_uvis1 & (ys >= 2051), ys - (2051 - 3), ys)
+    else:
+        sci_exts = chips
+
     n_subarray_sources = (~mask_full_frame).sum()
     print(f'Found {n_subarray_sources} subarray sources in queried data.')
-    return dataURIs
+
+    def _iter():
+        for iden, root, filt, x, y, sci_ext, size in zip(
+                ids, roots, filts, xs, ys, sci_exts, sizes_arr):
+            # The cutout geometry only depends on the source, so build it
+            # once per row rather than once per suffix
+            cutout = f'size={size}&x={x}&y={y}&format=fits'
+
+            # Make dataURIs for each suffix
+            for suffix in file_suffix:
+                file_read = f'red={root}_{suffix}[{sci_ext}]'
+                file_save = f'{root}_{iden}_{filt}_{suffix}_cutout.fits'
+                dataURI = f'{dataURI_base}?{file_read}&{cutout}/{file_save}'
+                yield ("uri", dataURI)
+
+    return _iter()
+
+
+def make_dataURIs(obs, detector, file_suffix, sizes={'unsat': 51, 'sat': 101}):
+    """
+    Make dataURIs for the WFC3 and WFPC2 PSF databases' sources.
+
+    The dataURIs are URLs for downloading cutouts from the MAST Portal.
+    The cutouts are made using the package fitscut.
+    They can retrieve:
+        - raw data with suffixes 'raw' for WFC3 and 'd0m' for WFPC2.
+        - calibrated data with suffixes 'flt' for WFC3 and 'c0m' for WFPC2.
+        - charge transfer efficiency (CTE) corrected data with the suffix 'flc'
+          for UVIS.
+
+    This returns the full list; use `iter_dataURIs` to stream the
+    dataURIs into a consumer without materializing them all.
+
+    Parameters
+    ----------
+    obs : astropy.table.Table
+        A table of the queried sources' metadata with specific filters and
+        columns applied.
+    detector : str
+        The detector of the queried sources. Allowed values are UVIS, IR, and
+        WFPC2.
+    file_suffix : list
+        The file suffixes to prepare for download.
+    sizes : dict, default={'unsat':51, 'sat':101}
+        The sizes for unsaturated (qfit>0;n_sat_pixels==0) and saturated
+        (qfit==0;n_sat_pixels>0) cutouts.
+
+    Returns
+    -------
+    dataURIs : list
+        The dataURIs made from the queried sources as ('uri', dataURI).
+    """
+    return list(iter_dataURIs(obs, detector, file_suffix, sizes=sizes))